@@ -6,25 +6,38 @@ import sys
 load_dotenv()
 
 from pymongo import MongoClient
+from pymongo.errors import BulkWriteError
 import numpy as np
 import pandas as pd
 import rasterio
 import matplotlib.pyplot as plt
+from matplotlib import colormaps
+from PIL import Image
 import time
 from datetime import datetime
 from pathlib import Path
 import json
-from pyproj import Proj
+from pyproj import Transformer
 import uuid
 from tqdm import tqdm
 import gc
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import model_data
 
 IS_CPU_MODE = os.getenv("IS_CPU_MODE").lower() == "true"
 IS_IN_PRODUCTION_MODE = os.getenv("IS_PRODUCTION_MODE").lower() == "true"
 VISUALIZE_PREDICTIONS = os.getenv("VISUALIZE_PREDICTIONS").lower() == "true"
+DUMP_CSV = (os.getenv("DUMP_CSV") or "false").lower() == "true" # per-tif csv of model inputs and predictions, for debugging (slow)
+# Number of processes that tifs are run across. GPU mode defaults to 1, since CUDA does not survive a fork
+NUM_WORKERS = int(os.getenv("NUM_WORKERS") or (os.cpu_count() if IS_CPU_MODE else 1))
+if VISUALIZE_PREDICTIONS:
+    NUM_WORKERS = 1 # plt.show() needs to run in the main process
 print("IS_CPU_MODE: ", IS_CPU_MODE)
 print("IS_IN_PRODUCTION_MODE: ", IS_IN_PRODUCTION_MODE)
+print("DUMP_CSV: ", DUMP_CSV)
+print("NUM_WORKERS: ", NUM_WORKERS)
 
 print("\nCalling model training module...")
 if IS_CPU_MODE:
@@ -32,23 +45,36 @@ if IS_CPU_MODE:
 else:
     import model_training
 andrew_model = model_training.andrew_model
+if hasattr(andrew_model, "n_jobs"): # sklearn (CPU) model, predict is multithreaded over trees
+    # When tifs are already spread across processes, one thread per process avoids oversubscribing the cores
+    andrew_model.n_jobs = 1 if NUM_WORKERS > 1 else -1
+if not VISUALIZE_PREDICTIONS:
+    # The training module may have shown its charts by now. Nothing else is shown, so switch to the non-interactive backend (also safe to use in forked workers)
+    plt.switch_backend("Agg")
+    plt.close("all") # don't keep the training module's figures alive for the run (and copied into every worker)
+
+# Only the column names are needed from here on, so free the training data and train/test splits before the run (and before forking workers)
+# (model_data's lookup tables are kept, get_constants needs them)
+COLUMNS = list(model_training.X_test.columns)
+for module, names in (
+    (model_training, ("training_data", "X", "y", "X_train", "X_test", "y_train", "y_test", "y_pred", "all_insitu_predicted")),
+    (model_data, ("training_data", "all_data_cleaned", "all_data_uncleaned")),
+):
+    for name in names:
+        if hasattr(module, name):
+            delattr(module, name)
+gc.collect()
 
 print("Finished calling model training module!\n")
 
-if IS_IN_PRODUCTION_MODE:
-    mongo_client = MongoClient(os.getenv("MONGO_CONNECTION_URI"))
-    mongo_prod_db = mongo_client["prod"]
-    mongo_lakes_collection = mongo_prod_db.lakes
-    mongo_spatial_predictions_collection = mongo_prod_db.spatial_predictions
-
-    all_lakes = list(mongo_lakes_collection.find({}))
-
 session_uuid = str(uuid.uuid4())
 print("Current session id: ", session_uuid)
 
 
 input_tif_folder = os.getenv("INPUT_TIF_FOLDER") # Specify the folder inside of the tar
-paths = os.listdir(input_tif_folder)
+# Largest tifs first, so the slowest files don't end up as the tail of the run (process pool load balancing)
+with os.scandir(input_tif_folder) as entries:
+    paths = [entry.path for entry in sorted(entries, key=lambda entry: entry.stat().st_size, reverse=True)]
 print("Number of files to run: ", len(paths))
 
 png_out_folder = os.path.join("all_png_out", f"png_out_{session_uuid}")
@@ -64,6 +90,8 @@ if not os.path.exists(session_statues_path):
     os.makedirs(session_statues_path)
 
 error_paths = []
+pending_uploads = [] # (path_tif, body) pairs waiting to be inserted into spatial_predictions
+UPLOAD_BATCH_SIZE = 100
 
 
 def add_suffix_to_filename_at_tif_path(filename : str, suffix : str):
@@ -75,90 +103,127 @@ def add_suffix_to_filename_at_tif_path(filename : str, suffix : str):
     return to_tif_folder_path
 
 
-def modify_tif(input_tif : str, SA_SQ_KM_FROM_SHAPEFILE_constant : float, pct_dev_constant: float, pct_ag_constant : float) -> str:
-    with rasterio.open(input_tif) as src:
-        raster_data = src.read()
-        profile = src.profile  # Get the profile of the existing raster
-        tags = src.tags()
-    
+transformer_cache = {} # crs wkt -> Transformer, most tifs share a handful of UTM zones
+
+def get_transformer_to_latlong(crs) -> Transformer:
+    key = crs.to_wkt()
+    transformer = transformer_cache.get(key)
+    if transformer is None:
+        transformer = Transformer.from_crs(crs, "EPSG:4326", always_xy=True)
+        transformer_cache[key] = transformer
+    return transformer
+
+
+# Tiled + compressed layout for the (debug) modified tif, regardless of how the source tif is laid out
+MODIFIED_TIF_CREATION_OPTIONS = {
+    "tiled": True,
+    "blockxsize": 512,
+    "blockysize": 512,
+    "compress": "deflate",
+    "predictor": 3, # floating point predictor, since bands are float32
+    "num_threads": 1 if NUM_WORKERS > 1 else "ALL_CPUS", # one GDAL thread per process when tifs are spread across processes
+    "BIGTIFF": "IF_SAFER",
+}
+
+# Flat float32 (model is fed float32) buffer reused by every modify_tif call (per process), grown to the largest raster seen so far
+modified_data_buf = np.empty(0, dtype=np.float32)
+
+def get_modified_data_buffer(n_bands : int, n_rows : int, n_cols : int) -> np.ndarray:
+    global modified_data_buf
+    n_values = n_bands * n_rows * n_cols
+    if modified_data_buf.size < n_values:
+        modified_data_buf = np.empty(n_values, dtype=np.float32)
+    return modified_data_buf[:n_values].reshape((n_bands, n_rows, n_cols))
+
+
+def modify_tif(src, SA_SQ_KM_FROM_SHAPEFILE_constant : float, pct_dev_constant: float, pct_ag_constant : float):
+    # src is the already open input tif (rasterio dataset), so it is only opened once per tif
+    input_tif = src.name
+    profile = src.profile  # Get the profile of the existing raster
+    tags = src.tags()
+
     # print(tags)
     satellite = tags["satellite"]
     # print("satellite: ", satellite)
 
-    # create new bands
-    SA_SQ_KM_band = np.full_like(raster_data[0], SA_SQ_KM_FROM_SHAPEFILE_constant, dtype=raster_data.dtype)
-    # Max_depth_band = np.full_like(raster_data[0], Max_depth_constant, dtype=raster_data.dtype)
-    pct_dev_band = np.full_like(raster_data[0], pct_dev_constant, dtype=raster_data.dtype)
-    pct_ag_band = np.full_like(raster_data[0], pct_ag_constant, dtype=raster_data.dtype)
-
-    # update profile to reflect additional bands
-    profile.update(count=12)  # (update count to include original bands + 4 new bands)
-
-    # output GeoTIFF file
-    modified_tif = add_suffix_to_filename_at_tif_path(input_tif, "modified")
     if satellite.startswith("sentinel"):
         bands_to_fill = 0
     elif satellite.startswith("landsat"):
         bands_to_fill = 9 - 5 # Landsat has 5, not 9 bands, so fill 4 bands
     else:
         raise Exception(f'Satellite "{satellite}" predictions not implemented yet.')
-    
-    with rasterio.open(modified_tif, 'w', **profile) as dst:
-        # write original bands
-        for i in range(1, raster_data.shape[0] + 1):
-            dst.write(raster_data[i-1], indexes=i)
 
-        bands_to_fill = 9 - 5 
-        for i in range(raster_data.shape[0] + 1, raster_data.shape[0] + 1 + bands_to_fill):
-            # print(f"Writing null band... at ({i})")
-            null_band = np.full_like(raster_data[0], model_data.NAN_SUBSTITUTE_CONSANT, dtype=raster_data.dtype)
-            dst.write(null_band, indexes=i)
+    # original bands, then null bands, then additional bands
+    n_orig_bands = src.count
+    modified_data = get_modified_data_buffer(n_orig_bands + bands_to_fill + 3, src.height, src.width)
+    src.read(out=modified_data[:n_orig_bands]) # read original bands straight into the output
+
+    # fill the null and additional (constant) bands in place, instead of allocating a full band per constant
+    fill_values = np.array([model_data.NAN_SUBSTITUTE_CONSANT] * bands_to_fill + [SA_SQ_KM_FROM_SHAPEFILE_constant, pct_dev_constant, pct_ag_constant], dtype=np.float32)
+    modified_data[n_orig_bands:] = fill_values[:, None, None]
+
+    # update profile to reflect additional bands
+    profile.update(count=12, dtype="float32")  # (update count to include original bands + 4 new bands)
+
+    # The modified tif is only written to disk for debugging, predict uses modified_data directly
+    modified_tif = None
+    if not IS_IN_PRODUCTION_MODE:
+        modified_tif = add_suffix_to_filename_at_tif_path(input_tif, "modified")
+        with rasterio.open(modified_tif, 'w', **{**profile, **MODIFIED_TIF_CREATION_OPTIONS}) as dst:
+            dst.write(modified_data)
+        # print(f"Created {modified_tif} with the four extra bands data from constants")
+
+    return modified_tif, modified_data, profile
 
-        # # write additional bands
-        dst.write(SA_SQ_KM_band, indexes=raster_data.shape[0] + bands_to_fill + 1)
-        dst.write(pct_dev_band, indexes=raster_data.shape[0] + bands_to_fill + 2)
-        dst.write(pct_ag_band, indexes=raster_data.shape[0] + bands_to_fill + 3)
 
-        dst.transform = src.transform
-        dst.crs = src.crs
+PREDICT_CHUNK_SIZE = 1_000_000 # rows (pixels) passed to andrew_model.predict per call
 
-    # print(f"Created {modified_tif} with the four extra bands data from constants")
-    return modified_tif
+# (n_samples, n_bands) float32 buffer reused by every predict call (per process), grown to the largest raster seen so far
+sample_buf = np.empty((0, 12), dtype=np.float32)
 
+def get_sample_buffer(n_samples : int, n_bands : int) -> np.ndarray:
+    global sample_buf
+    if sample_buf.shape[0] < n_samples or sample_buf.shape[1] != n_bands:
+        sample_buf = np.empty((n_samples, n_bands), dtype=np.float32)
+    return sample_buf[:n_samples]
 
-def predict(input_tif : str, lakeid: int, tags, display = True):
-    modified_tif = add_suffix_to_filename_at_tif_path(input_tif, "modified")
-    with rasterio.open(modified_tif) as src:
-        raster_data = src.read()
-        profile = src.profile
 
+def predict(input_tif : str, raster_data : np.ndarray, profile, lakeid: int, tags, display = True):
     n_bands, n_rows, n_cols = raster_data.shape
     n_samples = n_rows * n_cols
-    raster_data_2d = raster_data.transpose(1, 2, 0).reshape((n_samples,n_bands))
+    # if first band at that pixel is nan, inf, or -inf, usually rest are too, so only those pixels are worth predicting on (rest are left nan in output)
+    valid_idx = np.flatnonzero(np.isfinite(raster_data[0]))
+    n_valid = valid_idx.size
 
-    non_finite_val_mask = ~np.isfinite(raster_data[0]) # if first band at that pixel is nan, inf, or -inf, usually rest are too (helps remove "garbage" val from output later)
-    
-    raster_data_2d[~np.isfinite(raster_data_2d)] = model_data.NAN_SUBSTITUTE_CONSANT # Replace with NAN_SUB_CONSTANT or mean of general, but this pixels output  will later be removed anyway
+    # gather the valid pixels of each (bands, rows, cols) band straight into the band-last buffer, one row per pixel
+    raster_data_2d = get_sample_buffer(n_valid, n_bands)
+    for band in range(n_bands):
+        np.take(raster_data[band].reshape(-1), valid_idx, out=raster_data_2d[:, band])
 
-    # perform the prediction
-    predictions = andrew_model.predict(raster_data_2d)
+    # Replace nan, inf, and -inf in the remaining bands with NAN_SUB_CONSTANT in place (single pass)
+    np.nan_to_num(raster_data_2d, copy=False, nan=model_data.NAN_SUBSTITUTE_CONSANT, posinf=model_data.NAN_SUBSTITUTE_CONSANT, neginf=model_data.NAN_SUBSTITUTE_CONSANT)
 
-    if not IS_IN_PRODUCTION_MODE:
-        df = pd.DataFrame(raster_data_2d, columns=model_training.X_test.columns)
+    # perform the prediction, in chunks of rows to bound the memory the model's predict allocates at once
+    valid_predictions = np.empty(n_valid, dtype=np.float32)
+    for start in range(0, n_valid, PREDICT_CHUNK_SIZE):
+        valid_predictions[start:start + PREDICT_CHUNK_SIZE] = andrew_model.predict(raster_data_2d[start:start + PREDICT_CHUNK_SIZE])
+
+    if DUMP_CSV:
+        df = pd.DataFrame(raster_data_2d, columns=COLUMNS)
         df["lagoslakeid"] = lakeid
-        df["pred"] = predictions
+        df["pred"] = valid_predictions
         df = df.drop_duplicates()
         output_tif_csv = add_suffix_to_filename_at_tif_path(input_tif, "predicted") + '.csv'
-        df.to_csv(output_tif_csv)
+        df.to_csv(output_tif_csv, chunksize=100_000)
         print("csv saved to " +  os.path.join(os.getcwd(), output_tif_csv))
 
     # print(predictions)
 
-    # reshape the predictions back to the original raster shape
+    # scatter the predictions back into the original raster shape, pixels whose input was originally nan, -inf, or inf stay nan
+    predictions = np.full(n_samples, np.nan, dtype=np.float32)
+    predictions[valid_idx] = valid_predictions
     predictions_raster = predictions.reshape(n_rows, n_cols)
 
-    predictions_raster[non_finite_val_mask] = np.nan # if the input value was originally nan, -inf, or, ignore its (normal-seeming) output and make it nan
-
     if not IS_IN_PRODUCTION_MODE:
         print("Min predictions: ", np.nanmin(predictions_raster))
         print("Max predictions: ", np.nanmax(predictions_raster))
@@ -181,6 +246,7 @@ def predict(input_tif : str, lakeid: int, tags, display = True):
         plt.colorbar()
         plt.title(f"Predicted values for lake{lakeid} on {tags["date"]}")
         plt.show()
+        plt.close("all") # don't let pyplot hold on to a figure per tif
 
     return output_tif, predictions_raster
 
@@ -189,39 +255,64 @@ def save_png(input_tif, out_folder, predictions_raster, date, scale, display=Tru
     # Masking of NaNs already happens in predict function, so no need to mask here
     min_value = 0
     max_value = 60
-    increment = 5
 
-    fig = plt.figure(figsize=(10, 8))
-    plt.imshow(predictions_raster, cmap='viridis', interpolation='none', vmin=min_value, vmax=max_value)
-    plt.axis('off')
+    # Color each pixel directly (one png pixel per raster pixel), no matplotlib figure needed
+    normalized = np.clip((predictions_raster - min_value) / (max_value - min_value), 0, 1)
+    rgba = colormaps["viridis"](normalized, bytes=True)
+    rgba[..., 3] = np.where(np.isnan(predictions_raster), 0, 255) # nan pixels are transparent
     stem = Path(input_tif).stem
 
-    # values = np.arange(min_value, max_value + increment, increment)
-    # cbar = plt.colorbar()
-    # cbar.set_label(f'Predicted chlorophyll-A in ug/L \n ({date}, scale: {scale})')
-    # cbar.set_ticks(values)
-    # cbar.set_ticklabels([str(val) for val in values])
-
     # png filename
     output_png = stem + ".png"
     output_png_path = os.path.join(out_folder, output_png)
     # save the png
-    plt.savefig(output_png_path, format='png', bbox_inches='tight', pad_inches=0, transparent=True)
+    Image.fromarray(rgba).save(output_png_path, "PNG")
     if display:
+        plt.imshow(rgba, interpolation='none')
+        plt.axis('off')
         plt.show()
-    else:
-        plt.close(fig)
+        plt.close("all")
     return output_png_path
 
 
-def upload_spatial_map(lakeid : int, raster_image_path: str, display_image_path : str, datestr : str, corners : list, scale : int):
+def record_success(path_tif : str):
+    success_file.write(path_tif +"\n")
+
+
+def flush_uploads():
+    # Inserts every pending spatial prediction in one round trip, then records each path as a success or an error
+    if len(pending_uploads) == 0:
+        return
+
+    pending_paths = [path_tif for path_tif, _ in pending_uploads]
+    bodies = [body for _, body in pending_uploads]
+    pending_uploads.clear()
+
+    failed_indexes = set()
+    try:
+        mongo_spatial_predictions_collection.insert_many(bodies, ordered=False)
+    except BulkWriteError as e: # ordered=False, so only the documents listed here failed
+        print("Error: ", e)
+        failed_indexes = {write_error["index"] for write_error in e.details["writeErrors"]}
+    except Exception as e:
+        print("Error: ", e)
+        failed_indexes = set(range(len(bodies)))
+
+    for i, path_tif in enumerate(pending_paths):
+        if i in failed_indexes:
+            error_paths.append(path_tif)
+        else:
+            record_success(path_tif)
+
+
+def upload_spatial_map(path_tif : str, lakeid : int, raster_image_path: str, display_image_path : str, datestr : str, corners : list, scale : int):
     # Step 1: Find Lakeid
 
-    filtered_list = list(filter(lambda lake: lake["lagoslakeid"] == lakeid, all_lakes))
-    if len(filtered_list) == 0:
+    lake = lakes_by_id.get(lakeid)
+    if lake is None:
         raise Exception(f'No lake was found with lagoslakeid of "{lakeid}"')
 
-    lake_db_id = filtered_list[0]["_id"]
+    lake_db_id = lake["_id"]
 
     dateiso = datetime.strptime(datestr, '%Y-%m-%d').isoformat()
     # Step 2
@@ -239,10 +330,13 @@ def upload_spatial_map(lakeid : int, raster_image_path: str, display_image_path
         "lake" : lake_db_id,
         "lagoslakeid" : lakeid
     }
-    mongo_spatial_predictions_collection.insert_one(body)
+    pending_uploads.append((path_tif, body))
+    if len(pending_uploads) >= UPLOAD_BATCH_SIZE:
+        flush_uploads()
+
 
-for path_tif in tqdm(paths):
-    path_tif = os.path.join(input_tif_folder, path_tif)
+def process_one(path_tif : str):
+    # Runs inside a worker process. Mongo uploads and status file writes are left to the parent process (single writer)
     try:
         # print(f"Opening {path_tif  }")
         with rasterio.open(path_tif) as raster:
@@ -255,39 +349,83 @@ for path_tif in tqdm(paths):
             bottom_right = raster.transform * (raster.width, raster.height)
             crs = raster.crs
 
-        p = Proj(crs)
-        # Output is in the format: (lat, long)
-        corner1 = list(p(top_left[0], top_left[1], inverse=True)[::-1])
-        corner2 = list(p(bottom_right[0], bottom_right[1], inverse=True)[::-1])
-        corners = [corner1, corner2]
-        # print("id: ", id, " date: ", date, " scale: ", scale, " corners: ", corners)
+            # Both corners in one call, output is in the format: (long, lat)
+            longs, lats = get_transformer_to_latlong(crs).transform([top_left[0], bottom_right[0]], [top_left[1], bottom_right[1]])
+            # corners are in the format: (lat, long)
+            corner1 = [lats[0], longs[0]]
+            corner2 = [lats[1], longs[1]]
+            corners = [corner1, corner2]
+            # print("id: ", id, " date: ", date, " scale: ", scale, " corners: ", corners)
 
-        # Get constants
-        SA_SQ_KM_constant, pct_dev_constant, pct_ag_constant = model_data.get_constants(id)
-        # print(f"Constants based on id({id}): ", SA_SQ_KM_constant, pct_dev_constant, pct_ag_constant)
+            # Get constants
+            SA_SQ_KM_constant, pct_dev_constant, pct_ag_constant = model_data.get_constants(id)
+            # print(f"Constants based on id({id}): ", SA_SQ_KM_constant, pct_dev_constant, pct_ag_constant)
 
-        modified_path_tif = modify_tif(path_tif, SA_SQ_KM_constant, pct_dev_constant, pct_ag_constant)
+            modified_path_tif, modified_data, profile = modify_tif(raster, SA_SQ_KM_constant, pct_dev_constant, pct_ag_constant)
 
-        output_tif, predictions_loop = predict(path_tif, id, tags, display = VISUALIZE_PREDICTIONS)
+        output_tif, predictions_loop = predict(path_tif, modified_data, profile, id, tags, display = VISUALIZE_PREDICTIONS)
 
         if VISUALIZE_PREDICTIONS:
             print("Output tif: ", os.path.join(os.getcwd(),output_tif))
 
         output_path_png = save_png(path_tif, png_out_folder, predictions_loop, date, scale, display = False)
-        
-        if IS_IN_PRODUCTION_MODE:
-            upload_spatial_map(id, output_tif, output_path_png, date, corners, scale)
+        return path_tif, (id, output_tif, output_path_png, date, corners, scale), None
+    except Exception as e:
+        return path_tif, None, str(e) # str, since not every exception can be pickled back to the parent
 
-        with open(os.path.join(session_statues_path, f"successes_{session_uuid}.status.txt"), "a") as file_obj:
-            file_obj.write(path_tif +"\n")
 
-        gc.collect() # Clear memory after prediction
-    except Exception as e:
+# Opened once for the whole run, line buffered so finished tifs are on disk even if the run dies
+success_file = open(os.path.join(session_statues_path, f"successes_{session_uuid}.status.txt"), "a", buffering=1)
+
+executor = None
+n_results = 0 # results come back in the order of paths, so paths[n_results:] never finished
+try:
+    if NUM_WORKERS > 1:
+        # fork (not spawn/forkserver) so workers inherit the trained model and the rest of the module globals.
+        # With fork, every worker is started on the first submit (inside map), so before Mongo connects below (MongoClient must not cross a fork)
+        executor = ProcessPoolExecutor(max_workers=NUM_WORKERS, mp_context=multiprocessing.get_context("fork"))
+        results = executor.map(process_one, paths, chunksize=4)
+    else:
+        results = map(process_one, paths)
+
+    if IS_IN_PRODUCTION_MODE:
+        mongo_client = MongoClient(os.getenv("MONGO_CONNECTION_URI"))
+        mongo_prod_db = mongo_client["prod"]
+        mongo_lakes_collection = mongo_prod_db.lakes
+        mongo_spatial_predictions_collection = mongo_prod_db.spatial_predictions
+
+        all_lakes = list(mongo_lakes_collection.find({}))
+        lakes_by_id = {lake["lagoslakeid"]: lake for lake in reversed(all_lakes)} # reversed, so the first lake with a given lagoslakeid wins
+
+    try:
+        for path_tif, upload_args, error in tqdm(results, total=len(paths)):
+            n_results += 1
+            try:
+                if error is not None:
+                    raise Exception(error)
+
+                if IS_IN_PRODUCTION_MODE:
+                    upload_spatial_map(path_tif, *upload_args) # success is recorded once its batch is inserted
+                else:
+                    record_success(path_tif)
+            except Exception as e:
+                print("Error: ", e)
+                error_paths.append(path_tif)
+    except BrokenProcessPool as e: # a worker died (OOM kill, segfault, ...), so no more results will come back
         print("Error: ", e)
-        error_paths.append(path_tif)
+        error_paths.extend(paths[n_results:])
+finally:
+    # Insert whatever is still queued even if the run was interrupted, those tifs are already predicted
+    if IS_IN_PRODUCTION_MODE:
+        flush_uploads()
+
+    success_file.close()
+
+    if executor is not None:
+        executor.shutdown(cancel_futures=True)
 
-print(f"Successfully finished {len(paths)} uploads with {len(error_paths)} errors")
-print("Session ID: ", session_uuid)
+    print(f"Successfully finished {len(paths)} uploads with {len(error_paths)} errors")
+    print("Session ID: ", session_uuid)
 
-with open(os.path.join(session_statues_path, f"error_paths_{session_uuid}.json"), "w") as file:
-    file.write(json.dumps(error_paths))
+    with open(os.path.join(session_statues_path, f"error_paths_{session_uuid}.json"), "w") as file:
+        file.write(json.dumps(error_paths))